@@ -1,8 +1,17 @@
+import hashlib
 import hfst
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 
 from symbols import *
 
+_symbols_esc_set = frozenset(symbols_esc)
+_faithfulness_fmt = "[ " + in_sym + " {0} " + out_sym + " \\{0} ]"
+_maximality_fmt = "[ " + in_sym + " {0} " + out_sym + " " + no_sym + " ]"
+_dependency_fmt = "[ " + in_sym + " " + no_sym + " " + out_sym + " {0} ]"
+
 
 class Scope(Enum):
     """ The scope of a constraint, i.e. the part of an input it should apply within. """
@@ -16,31 +25,44 @@ class Scope(Enum):
 
     def ignore(self):
         """ :return: A regex for the boundary marks to ignore given the scope of the constraint. """
-        if self is Scope.ONSET or self is Scope.NUCLEUS or self is Scope.CODA: return ""
-        if self is Scope.CONS_CLUSTER: return syl_bound
-        ignore = "[ " + nucl_bound
-        if self is Scope.PHRASE: ignore += " | " + word_bound
-        if self is not Scope.SYLLABLE: ignore += " | " + syl_bound
-        ignore += " ]"
-        return ignore
+        return _scope_ignore[self]
 
     def left_border(self):
         """ :return: The left boundary mark of the scope. """
-        border = ""
-        if self is Scope.PHRASE: border = ".#."
-        elif self is Scope.WORD: border = word_bound
-        elif self is Scope.SYLLABLE or self is Scope.ONSET: border = syl_bound
-        elif self is Scope.NUCLEUS or self is Scope.CODA or self is Scope.CONS_CLUSTER: border = nucl_bound
-        return border
+        return _scope_left_border[self]
 
     def right_border(self):
         """ :return: The right boundary mark of the scope. """
-        border = ""
-        if self is Scope.PHRASE: border = ".#."
-        elif self is Scope.WORD: border = word_bound
-        elif self is Scope.SYLLABLE or self is Scope.CODA: border = syl_bound
-        elif self is Scope.NUCLEUS or self is Scope.ONSET or self is Scope.CONS_CLUSTER: border = nucl_bound
-        return border
+        return _scope_right_border[self]
+
+
+_scope_ignore = {
+    Scope.PHRASE: "[ " + nucl_bound + " | " + word_bound + " | " + syl_bound + " ]",
+    Scope.WORD: "[ " + nucl_bound + " | " + syl_bound + " ]",
+    Scope.SYLLABLE: "[ " + nucl_bound + " ]",
+    Scope.ONSET: "",
+    Scope.NUCLEUS: "",
+    Scope.CODA: "",
+    Scope.CONS_CLUSTER: syl_bound
+}
+_scope_left_border = {
+    Scope.PHRASE: ".#.",
+    Scope.WORD: word_bound,
+    Scope.SYLLABLE: syl_bound,
+    Scope.ONSET: syl_bound,
+    Scope.NUCLEUS: nucl_bound,
+    Scope.CODA: nucl_bound,
+    Scope.CONS_CLUSTER: nucl_bound
+}
+_scope_right_border = {
+    Scope.PHRASE: ".#.",
+    Scope.WORD: word_bound,
+    Scope.SYLLABLE: syl_bound,
+    Scope.ONSET: nucl_bound,
+    Scope.NUCLEUS: nucl_bound,
+    Scope.CODA: syl_bound,
+    Scope.CONS_CLUSTER: nucl_bound
+}
 
 
 class Constraint:
@@ -54,6 +76,7 @@ class Constraint:
         self._regex = regex
         self._n = n
         self._name = str(id(self._regex)) if name is None else name
+        self._compiled = None
 
     def apply(self, candidates, no_penalty=False, no_pardon=False, method="matching"):
         """
@@ -65,11 +88,21 @@ class Constraint:
         :param method: The penalization method to apply, matching (default) or counting
         :return: The updated candidate set FST
         """
-        candidates.compose(hfst.regex(self._regex))
+        self._mark(candidates)
         if not no_penalty:
             penalize(candidates, n=self._n, no_pardon=no_pardon, method=method)
         return candidates
 
+    def _mark(self, candidates):
+        """ Insert the violation marks into the candidate set. """
+        candidates.compose(self._get_fst())
+
+    def _get_fst(self):
+        """ :return: A copy of the constraint FST, compiled on first use """
+        if self._compiled is None:
+            self._compiled = _compile(self._regex)
+        return self._compiled.copy()
+
     def n(self):
         return self._n
 
@@ -102,17 +135,41 @@ class SingleConstraint(Constraint):
 class ConstraintBundle(Constraint):
     """ A bundle of multiple constraints to be applied simultaneously. """
 
-    def __init__(self, constraints, n=15, name=None):
+    def __init__(self, constraints, n=15, name=None, parallel=False, precompose=False):
         """
         :param constraints: A collection of constraints
         :param n: The penalization precision for the counting approach
+        :param parallel: Compile the FSTs of the constraints right away in parallel worker processes
+                         (worthwhile for large bundles)
+        :param precompose: Compose the constraint FSTs into a single FST once and apply that, instead of
+                           composing them onto the candidates one by one (worthwhile for many small constraints)
         """
-        regex = ""
-        for constraint in constraints:
-            c_re = str(constraint).split("\t")[2]
-            regex += c_re + " .o. "
-        regex = regex[:-5]
+        self._constraints = list(constraints)
+        self._precompose = precompose
+        regex = " .o. ".join(str(constraint).split("\t")[2] for constraint in self._constraints)
         super().__init__(regex, n=n, name=name)
+        if parallel:
+            _precompile([constraint._regex for constraint in self._constraints
+                         if not isinstance(constraint, ConstraintBundle)])
+
+    def _mark(self, candidates):
+        """ Compose the constraints (or their precomposed FST) instead of compiling the cascade as one regex. """
+        if self._precompose:
+            candidates.compose(self._get_fst())
+            return
+        for constraint in self._constraints:
+            constraint._mark(candidates)
+            candidates.minimize()
+
+    def _get_fst(self):
+        """ :return: A copy of the composition of all constraint FSTs, built on first use """
+        if self._compiled is None:
+            fst = self._constraints[0]._get_fst()
+            for constraint in self._constraints[1:]:
+                fst.compose(constraint._get_fst())
+                fst.minimize()
+            self._compiled = optimize(fst)
+        return self._compiled.copy()
 
 
 class MarkednessConstraint(SingleConstraint):
@@ -134,9 +191,9 @@ class MarkednessConstraint(SingleConstraint):
         :param right: The right context
         :param n: The penalization precision for the counting approach
         """
-        if ignore is None: ignore = list()
+        ignore = list() if ignore is None else list(ignore)
         ignore.append(ignore_mark_input)
-        ignore.append(scope.ignore())
+        if scope.ignore() != "": ignore.append(scope.ignore())
         violation = _parse_violation(violation)
         if type(violation) is not str: violation = " ".join(violation)
         if not single_symbol: violation = _ignore(violation, ignore)
@@ -152,7 +209,7 @@ class MarkednessConstraintBundle(ConstraintBundle):
     """ A bundle of simultaneously executed categorical markedness constraints. """
 
     def __init__(self, violations, single_symbol=False, prefix=out_prefix, ignore=None, scope=Scope.WORD,
-                 left="", right="", n=15, name=None):
+                 left="", right="", n=15, name=None, parallel=False):
         """
         :param violations: A list of violations, each of which will be fed to a separate CategoricalMarkednessConstraint
                           constructor
@@ -165,13 +222,14 @@ class MarkednessConstraintBundle(ConstraintBundle):
         :param left: The left context
         :param right: The right context
         :param n: The penalization precision for the counting approach
+        :param parallel: Compile the constraint FSTs right away in parallel worker processes
         """
-        if ignore is None: ignore = list()
+        ignore = list() if ignore is None else list(ignore)
         ignore.append(mark_sym)
         constraints = [MarkednessConstraint(violation, single_symbol=single_symbol, prefix=prefix,
                                             ignore=ignore, scope=scope, left=left, right=right)
                        for violation in violations]
-        super().__init__(constraints, n=n, name=name)
+        super().__init__(constraints, n=n, name=name, parallel=parallel)
 
 
 class FaithfulnessConstraint(SingleConstraint):
@@ -187,22 +245,23 @@ class FaithfulnessConstraint(SingleConstraint):
         :param right: The right context
         :param n: The penalization precision for the counting approach
         """
-        if ignore is None: ignore = list()
+        ignore = list() if ignore is None else list(ignore)
         ignore.append(ignore_mark_input)
-        ignore.append(scope.ignore())
+        if scope.ignore() != "": ignore.append(scope.ignore())
         left = _parse_context(left)
         right = _parse_context(right)
         if left != "": left = _ignore(left, ignore)
         if right != "": right = _ignore(right, ignore)
         must_keep = _parse_violation(must_keep)
-        must_keep = "[ " + in_sym + " " + must_keep + " " + out_sym + " \\" + must_keep + " ]"
+        must_keep = _faithfulness_fmt.format(must_keep)
         super().__init__(must_keep, left=left, right=right, n=n, name=name)
 
 
 class FaithfulnessConstraintBundle(ConstraintBundle):
     """ A bundle of simultaneously executed faithfulness constraints. """
 
-    def __init__(self, must_keeps, ignore=None, scope=Scope.WORD, left="", right="", n=15, name=None):
+    def __init__(self, must_keeps, ignore=None, scope=Scope.WORD, left="", right="", n=15, name=None,
+                 parallel=False):
         """
         :param must_keeps: A list of phoneme sets to match, each of which will be fed to a separate
                           FaithfulnessConstraint constructor
@@ -211,12 +270,13 @@ class FaithfulnessConstraintBundle(ConstraintBundle):
         :param left: The left context
         :param right: The right context
         :param n: The penalization precision for the counting approach
+        :param parallel: Compile the constraint FSTs right away in parallel worker processes
         """
-        if ignore is None: ignore = list()
+        ignore = list() if ignore is None else list(ignore)
         ignore.append(mark_sym)
         constraints = [FaithfulnessConstraint(must_keep, ignore=ignore, scope=scope, left=left, right=right)
                        for must_keep in must_keeps]
-        super().__init__(constraints, n=n, name=name)
+        super().__init__(constraints, n=n, name=name, parallel=parallel)
 
 
 class MaximalityConstraint(MarkednessConstraint):
@@ -230,7 +290,7 @@ class MaximalityConstraint(MarkednessConstraint):
         :param right: The right context
         :param n: The penalization precision for the counting approach
         """
-        maximality = "[ " + in_sym + " " + _parse_violation(maximality) + " " + out_sym + " " + no_sym + " ]"
+        maximality = _maximality_fmt.format(_parse_violation(maximality))
         super().__init__(maximality, single_symbol=True, prefix="", scope=scope, ignore=ignore,
                          left=left, right=right, n=n, name=name)
 
@@ -246,7 +306,7 @@ class DependencyConstraint(MarkednessConstraint):
         :param right: The right context
         :param n: The penalization precision for the counting approach
         """
-        dependency = "[ " + in_sym + " " + no_sym + " " + out_sym + " " + _parse_violation(dependency) + " ]"
+        dependency = _dependency_fmt.format(_parse_violation(dependency))
         super().__init__(dependency, single_symbol=True, prefix="", scope=scope, ignore=ignore,
                          left=left, right=right, n=n, name=name)
 
@@ -309,7 +369,7 @@ class HorizontalGradientConstraint(ConstraintBundle):
             constraints.append(GradientConstraint(violation, left_oriented=left_oriented,
                                                   ignore=ignore, scope=scope, border=border,
                                                   left=left, right=right, max_size=j))
-        super().__init__(constraints, n=n, name=name)
+        super().__init__(constraints, n=n, name=name, precompose=True)
 
 
 class ComplexOnsetConstraint(GradientConstraint):
@@ -349,7 +409,7 @@ class AssimilationConstraint(ConstraintBundle):
             left = feat
             viol = "\\[ " + _parse_violation(feat) + " ]"
             constraints.append(MarkednessConstraint(viol, scope=Scope.CONS_CLUSTER, left=left))
-        super().__init__(constraints, n=n, name=name)
+        super().__init__(constraints, n=n, name=name, precompose=True)
 
 
 def penalize(candidates, n=10, no_pardon=False, method="matching"):
@@ -363,54 +423,49 @@ def penalize(candidates, n=10, no_pardon=False, method="matching"):
     """
     if method == "counting":
         for i in reversed(range(n+1)):
-            penalty_i = hfst.regex(only_n_of(mark_sym, i))
-            candidates.lenient_composition(penalty_i)
+            candidates.lenient_composition(_compile(only_n_of(mark_sym, i)).copy())
     else:
-        # Remove modifications of gen, keep input characters and violation marks
-        strip = hfst.regex("[ [ " + in_sym + ":0 [ " + no_sym + ":0 .P. ? ] ]"
-                           + " | [ " + out_sym + " ? ]:0 | " + bound_syms + ":0 | " + mark_sym + " ]*")
-        # Insert at least one violation mark into the string
-        insert_marks = hfst.regex("[ ?* 0:" + mark_sym + "+ ?* ]+")
-        # Randomly insert new output characters
-        mutate_output = hfst.regex("[ ? | 0:? ]*")
-        # Randomly scatter violation marks throughout the string
-        permute1 = hfst.regex(
-            "[ ?* " + mark_sym + ":0 ?* 0:" + mark_sym + " ?* ]*")
-        permute2 = hfst.regex(
-            "[ ?* 0:" + mark_sym + " ?* " + mark_sym + ":0 ?* ]*")
-        # Compose everything
+        # Generate worse candidates from the actual ones
         worse = candidates.copy()
-        worse.compose(strip)
-        worse.compose(insert_marks)
-        worse.compose(permute1)
-        worse.compose(permute2)
-        worse.compose(mutate_output)
-        # Subtract worse candidates from actual candidates
+        worse.compose(_compile(_worse_regex).copy())
+        # Subtract worse candidates from actual candidates, then free the copy before minimizing
         candidates.subtract(worse)
+        del worse
         candidates.minimize()
 
     if not no_pardon: pardon(candidates)
     return candidates
 
 
+# The auxiliary FSTs of the matching approach only depend on the special symbols, so their cascade
+# is compiled as a single transducer mapping candidates to worse candidates
+_worse_regex = (
+    # Remove modifications of gen, keep input characters and violation marks
+    "[ [ " + in_sym + ":0 [ " + no_sym + ":0 .P. ? ] ] | [ " + out_sym + " ? ]:0 | " + bound_syms + ":0 | "
+    + mark_sym + " ]*"
+    # Insert at least one violation mark into the string
+    + " .o. [ ?* 0:" + mark_sym + "+ ?* ]+"
+    # Randomly scatter violation marks throughout the string
+    + " .o. [ ?* " + mark_sym + ":0 ?* 0:" + mark_sym + " ?* ]*"
+    + " .o. [ ?* 0:" + mark_sym + " ?* " + mark_sym + ":0 ?* ]*"
+    # Randomly insert new output characters
+    + " .o. [ ? | 0:? ]*")
+
+
 def pardon(constraint):
     """ Remove violation marks from surviving candidates. """
-    constraint.compose(hfst.regex(mark_sym + " -> 0"))
+    constraint.compose(_compile(mark_sym + " -> 0").copy())
 
 
 def _parse_violation(violation):
     if type(violation) is str:
         regex = violation
     elif all(isinstance(x, str) for x in violation):
-        regex = "[ " if len(violation) > 1 else ""
-        for viol in violation:
-            regex += _escape_string(viol) + " | "
-        regex = regex[:-3]
-        if len(violation) > 1: regex += " ]"
+        # Sorted so that the regex (and its FST cache key) does not depend on the set order of this run
+        regex = " | ".join(_escape_string(viol) for viol in sorted(violation))
+        if len(violation) > 1: regex = "[ " + regex + " ]"
     else:
-        regex = list()
-        for syms in violation:
-            regex.append(_parse_violation(syms))
+        regex = [_parse_violation(syms) for syms in violation]
     return regex
 
 
@@ -420,25 +475,137 @@ def _parse_context(context):
     context = _parse_violation(context)
     if type(context) is str:
         context = [context]
-    context = [con if con in symbols_esc else "[ " + out_prefix + " " + con + " ]"
+    context = [con if con in _symbols_esc_set else "[ " + out_prefix + " " + con + " ]"
                for con in context]
     context = " ".join(context)
     return context
 
 
 def _escape_string(string):
-    esc = "["
-    for ch in string:
-        esc += "%" + ch
-    return esc + "]"
+    return "[" + "".join("%" + ch for ch in string) + "]"
 
 
 def _ignore(regex, ignore):
-    ign_regex = "[ " + regex + " / [ "
-    for ign in ignore:
-        if ign != "":
-            ign_regex += ign + " | "
-    return ign_regex[:-3] + " ] ]"
+    ignore = [ign for ign in ignore if ign != ""]
+    if len(ignore) == 0: return regex
+    return "[ " + regex + " / [ " + " | ".join(ignore) + " ] ]"
+
+
+_regex_fst_cache = dict()
+# Compiled FSTs are also kept on disk across runs if INFINOT_FST_CACHE is set to a directory
+_fst_cache_dir = os.path.expanduser(os.environ.get("INFINOT_FST_CACHE", ""))
+
+
+def _compile(regex):
+    """
+    Compile a constraint regex, sharing the result between all constraints with the same regex
+    and, via the on-disk cache, between runs.
+    :param regex: A regular expression
+    :return: The optimized HfstTransducer (do not modify, copy it instead)
+    """
+    fst = _regex_fst_cache.get(regex)
+    if fst is None:
+        fst = _read_cached_fst(regex)
+        if fst is None:
+            fst = optimize(hfst.regex(regex))
+            _write_cached_fst(regex, fst)
+        _regex_fst_cache[regex] = fst
+    return fst
+
+
+def _cached_fst_path(regex):
+    key = hashlib.sha1((hfst.__version__ + "\n" + str(hfst.get_default_fst_type()) + "\n" + regex)
+                       .encode("utf8")).hexdigest()
+    return os.path.join(_fst_cache_dir, key + ".hfst")
+
+
+def _read_cached_fst(regex):
+    if _fst_cache_dir == "": return None
+    path = _cached_fst_path(regex)
+    # A truncated or foreign file is a cache miss, it is recompiled and overwritten. HFST aborts the whole
+    # process on some truncated files, so the file is checked against the digest written along with it first.
+    try:
+        with open(path + ".sha1", encoding="utf8") as digest_file:
+            digest = digest_file.read()
+        if _file_digest(path) != digest: return None
+    except OSError:
+        return None
+    fst_file = None
+    try:
+        fst_file = hfst.HfstInputStream(path)
+        fst = fst_file.read()
+    except (hfst.exceptions.HfstException, OSError):
+        return None
+    finally:
+        if fst_file is not None: fst_file.close()
+    # Transducers of another implementation type cannot be composed with freshly compiled ones
+    if fst.get_type() != hfst.get_default_fst_type(): return None
+    return fst
+
+
+def _write_cached_fst(regex, fst):
+    if _fst_cache_dir == "": return
+    path = _cached_fst_path(regex)
+    # Write to temporary files first so that parallel runs never read a partial FST or digest
+    tmp_path = path + "." + str(os.getpid())
+    try:
+        os.makedirs(_fst_cache_dir, exist_ok=True)
+        fst_file = hfst.HfstOutputStream(filename=tmp_path)
+        fst_file.write(fst)
+        fst_file.close()
+        digest = _file_digest(tmp_path)
+        os.replace(tmp_path, path)
+        with open(tmp_path, "w", encoding="utf8") as digest_file:
+            digest_file.write(digest)
+        os.replace(tmp_path, path + ".sha1")
+    except (hfst.exceptions.HfstException, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def _precompile(regexes):
+    """
+    Compile regexes missing from the cache in worker processes. HfstTransducers cannot be pickled,
+    so the workers hand them back as HFST files.
+    :param regexes: A list of regular expressions
+    """
+    regexes = list(dict.fromkeys(regex for regex in regexes if regex not in _regex_fst_cache))
+    if len(regexes) == 0: return
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = [os.path.join(tmp_dir, str(i) + ".hfst") for i in range(len(regexes))]
+        with ProcessPoolExecutor() as executor:
+            list(executor.map(_compile_to_file, regexes, paths))
+        for (regex, path) in zip(regexes, paths):
+            fst_file = hfst.HfstInputStream(path)
+            _regex_fst_cache[regex] = fst_file.read()
+            fst_file.close()
+
+
+def _compile_to_file(regex, path):
+    fst_file = hfst.HfstOutputStream(filename=path)
+    fst_file.write(_compile(regex))
+    fst_file.close()
+
+
+def optimize(fst):
+    """
+    Bring an FST that will be composed repeatedly into its smallest form. HFST offers no explicit
+    arc sorting or weight pushing worth doing on these weightless FSTs, so this removes epsilons,
+    determinizes and minimizes.
+    :param fst: An HfstTransducer, modified in place
+    :return: The same HfstTransducer
+    """
+    fst.remove_epsilons()
+    fst.determinize()
+    fst.minimize()
+    return fst
 
 
 def at_most_n_of(regex, n):
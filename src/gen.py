@@ -1,6 +1,7 @@
 import hfst
+from functools import lru_cache
 
-from constraint import at_most_n_of
+from constraint import at_most_n_of, optimize, _compile
 from symbols import *
 
 
@@ -34,8 +35,14 @@ class MorphGen(Generator):
         self._allow_ins = allow_ins
         self._allow_del = allow_del
         self._max_ins = max_ins
+        self._cached_fst = None
         
     def generate(self):
+        if self._cached_fst is None:
+            self._cached_fst = self._build_generator()
+        return self._cached_fst.copy()
+
+    def _build_generator(self):
         alph = _build_regex(self._alph.get_alphabet())
         mut = _build_regex(self._mut.get_alphabet())
         ignore = "" if self._ignore == "" else " | " + self._ignore
@@ -61,21 +68,22 @@ class MorphGen(Generator):
         # Loop mutator and compose with gen
         gen2.repeat_star()
         gen.compose(gen2)
+        gen.minimize()
 
         # Restrict insertions if desired
         if self._max_ins > 0:
-            restrict = hfst.regex(at_most_n_of(ins_sym, self._max_ins))
-            gen.compose(restrict)
+            gen.compose(_compile(at_most_n_of(ins_sym, self._max_ins)).copy())
+            gen.minimize()
 
         # Insert syllable boundaries if required
-        if self._syl is not None: gen.compose(self._syl.syllabify())
+        if self._syl is not None:
+            gen.compose(self._syl.syllabify())
+            gen.minimize()
 
         # Insert word boundaries
-        surround = hfst.regex("?* -> " + word_bound + " ... " + word_bound + " || .#. _ .#.")
-        gen.compose(surround)
+        gen.compose(_surround(word_bound))
 
-        gen.minimize()
-        return gen
+        return optimize(gen)
         
     
 class Syllabifier:
@@ -92,12 +100,15 @@ class RandomSyllabifier(Syllabifier):
     
     def __init__(self):
         """ A syllabifier that inserts syllable and nucleus boundaries randomly. """
+        self._cached_fst = None
         
     def syllabify(self):
-        c = in_sym + " \\" + out_sym + "+ " + out_sym + " \\" + in_sym + "+"
-        syl = hfst.regex("0 (->) " + syl_bound + " | " + nucl_bound + " || _ " + c + " , " + c + " _")
-        syl.minimize()
-        return syl
+        if self._cached_fst is None:
+            c = in_sym + " \\" + out_sym + "+ " + out_sym + " \\" + in_sym + "+"
+            syl = hfst.regex("0 (->) " + syl_bound + " | " + nucl_bound + " || _ " + c + " , " + c + " _")
+            syl.minimize()
+            self._cached_fst = syl
+        return self._cached_fst.copy()
 
 
 class NuclearSyllabifier(Syllabifier):
@@ -112,20 +123,28 @@ class NuclearSyllabifier(Syllabifier):
         self._alph = alph
         self._fill_onset = fill_onset
         self._sonorous = sonority_filter
+        self._cached_fst = None
 
     def syllabify(self):
+        if self._cached_fst is None:
+            self._cached_fst = self._build_syllabifier()
+        return self._cached_fst.copy()
+
+    def _build_syllabifier(self):
         v = "[ " + out_prefix + " " + _build_regex(self._alph.get_phonemes("+syllabic")) + " ]"
         c = "[ " + out_prefix + " " + _build_regex(self._alph.get_phonemes("-syllabic")) + " ]"
 
         fill_nucl = hfst.regex(v + " -> " + nucl_bound + " ... " + nucl_bound)
         syl = hfst.regex("0 -> " + syl_bound + " \/ " + nucl_bound + " " + c + "* _ " + c + "* " + nucl_bound)
-        surround = hfst.regex("?* -> " + syl_bound + " ... " + syl_bound + " || .#. _ .#.")
         fill_nucl.compose(syl)
-        fill_nucl.compose(surround)
+        fill_nucl.minimize()
+        fill_nucl.compose(_surround(syl_bound))
+        fill_nucl.minimize()
 
         if self._fill_onset:
             no_vowstart = hfst.regex("~[ $[ \\" + v + " " + syl_bound + " " + nucl_bound + " ] ]")
             fill_nucl.compose(no_vowstart)
+            fill_nucl.minimize()
 
         if self._sonorous:
             son_scale = self._alph.get_sonority_scale()
@@ -134,12 +153,8 @@ class NuclearSyllabifier(Syllabifier):
                 if not len(layer) == 0:
                     lregex = "[ " + out_prefix + " " + _build_regex(layer) + " ]"
                     scale.append(lregex)
-            suffix = ""
-            for layer in scale:
-                suffix += " " + layer + "*"
-            prefix = ""
-            for layer in reversed(scale):
-                prefix += layer + "* "
+            suffix = " ".join(layer + "*" for layer in scale)
+            prefix = " ".join(layer + "*" for layer in reversed(scale))
 
             son_filter = hfst.regex(syl_bound
                                     + " [ " + prefix + " "
@@ -151,22 +166,20 @@ class NuclearSyllabifier(Syllabifier):
         return fill_nucl
 
 
+def _surround(bound):
+    """ :return: A copy of the FST that surrounds the whole string with the given boundary mark """
+    return _compile("?* -> " + bound + " ... " + bound + " || .#. _ .#.").copy()
+
+
 def _build_regex(lexemes, is_regex=False):
     if len(lexemes) == 0:
-        regex = ""
-    else:
-        regex = "[ "
-        for lexeme in lexemes:
-            if is_regex:
-                regex += lexeme + " | "
-            else:
-                regex += _escape_string(lexeme) + " | "
-        regex = regex[:-3] + " ]"
-    return regex
+        return ""
+    # Sorted so that the regex does not depend on the set order of this run
+    if is_regex:
+        return "[ " + " | ".join(sorted(lexemes)) + " ]"
+    return "[ " + " | ".join(_escape_string(lexeme) for lexeme in sorted(lexemes)) + " ]"
 
 
+@lru_cache(maxsize=None)
 def _escape_string(string):
-    esc = "["
-    for ch in string:
-        esc += "%" + ch
-    return esc + "]"
+    return "[" + "".join("%" + ch for ch in string) + "]"
@@ -7,14 +7,16 @@ from tableau import Tableau
 
 if __name__ == '__main__':
     # Define alphabet
-    alph_en = {'A','A:','Q','{','V','e','E','@','i','i:','I','1','O','O:','u','u:','U',
-               'm','n','N','p','b','t','d','k','g','t)S','d)Z','f','v','T','D','s','z','S','Z','h','l','r\\','j','w'}
-    alph_hw = {'a','e','i','o','u','a:','e:','i:','o:','u:','p','k','m','n','l','w','h','?'}
+    alph_en = frozenset({'A','A:','Q','{','V','e','E','@','i','i:','I','1','O','O:','u','u:','U',
+                         'm','n','N','p','b','t','d','k','g','t)S','d)Z','f','v','T','D','s','z','S','Z',
+                         'h','l','r\\','j','w'})
+    alph_hw = frozenset({'a','e','i','o','u','a:','e:','i:','o:','u:','p','k','m','n','l','w','h','?'})
+    foreign = alph_en - alph_hw
     phono = PhonemeInventory(phonemes=alph_en | alph_hw)
     hw_phono = PhonemeInventory(phonemes=alph_hw)
 
     # Define constraints
-    no_foreign = MarkednessConstraint(alph_en-alph_hw, name="*foreign")
+    no_foreign = MarkednessConstraint(foreign, name="*foreign")
     faith_cv = FaithfulnessConstraintBundle(phono.get_feature_bundles("consonantal"), name="ID(cons)")
     max_io = MaximalityConstraint(name="Max(IO)")
     no_complex_onset = ComplexOnsetConstraint(phono.get_phonemes(["-syllabic"]), name="NoComplexOnset")
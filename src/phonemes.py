@@ -1,5 +1,6 @@
 from enum import Enum
 from collections import defaultdict
+from functools import lru_cache
 
 
 class PhoneticAlphabet(Enum):
@@ -33,37 +34,39 @@ class PhonemeInventory:
         phonemes = set(phonemes)
         self._phoneme_sets = defaultdict(set)
         self._feature_bundles = defaultdict(set)
+        self._phoneme_cache = dict()
+        self._bundle_cache = dict()
 
-        with open("phon_symbols.tsv", encoding="UTF-8") as sym_file:
-            sym_lines = sym_file.readlines()
-        with open("phon_diacritics.tsv", encoding="UTF-8") as dia_file:
-            dia_lines = dia_file.readlines()
-        sym_lines = [line.rstrip('\n') for line in sym_lines]
-        dia_lines = [line.rstrip('\n') for line in dia_lines]
-
-        header = sym_lines[1].split('\t')[2:]
-        for (i, supergroup) in enumerate(sym_lines[0].split('\t')[2:]):
+        (supergroups, header, sym_cols, dia_cols) = _load_tables()
+        for (i, supergroup) in enumerate(supergroups):
             feature = {"+"+header[i], "-"+header[i]}
             self._feature_bundles[header[i]] |= feature
             if supergroup != "":
                 self._feature_bundles[supergroup] |= feature
-        sym_lines = sym_lines[2:]
-        dia_lines = dia_lines[2:] if diacritics else [dia_lines[2]]
-
-        for sym_line in sym_lines:
-            for dia_line in dia_lines:
-                sym_vals = sym_line.split('\t')
-                dia_vals = dia_line.split('\t')
-                symbol = (sym_vals[0]+dia_vals[0]) if representation == PhoneticAlphabet.IPA \
-                    else (sym_vals[1]+dia_vals[1])
-                if len(phonemes) == 0 or symbol in phonemes:
-                    self._phoneme_sets["alph"].add(symbol)
-                    for (j, sym_val) in enumerate(sym_vals[2:]):
-                        dia_val = dia_vals[j+2]
-                        if dia_val != "0":
-                            self._phoneme_sets[dia_val+header[j]].add(symbol)
-                        elif sym_val != "0":
-                            self._phoneme_sets[sym_val+header[j]].add(symbol)
+
+        # Find the (symbol, diacritic) combinations in the inventory
+        rep = 0 if representation == PhoneticAlphabet.IPA else 1
+        n_dia = len(dia_cols[rep]) if diacritics else 1
+        matches = [(i, k, sym + dia_cols[rep][k])
+                   for (i, sym) in enumerate(sym_cols[rep]) for k in range(n_dia)]
+        if len(phonemes) > 0:
+            matches = [match for match in matches if match[2] in phonemes]
+        self._phoneme_sets["alph"].update(symbol for (_, _, symbol) in matches)
+
+        # Collect the feature values column by column; diacritic values override symbol values
+        for (j, feature_name) in enumerate(header):
+            sym_col = sym_cols[j+2]
+            dia_col = dia_cols[j+2]
+            # Phoneme sets of this feature by value, only created once a phoneme has that value
+            buckets = dict()
+            for (i, k, symbol) in matches:
+                value = dia_col[k]
+                if value == "0": value = sym_col[i]
+                if value != "0":
+                    bucket = buckets.get(value)
+                    if bucket is None:
+                        bucket = buckets[value] = self._phoneme_sets[value+feature_name]
+                    bucket.add(symbol)
 
     def get_alphabet(self):
         """ :return: All phonemes in the inventory """
@@ -76,13 +79,20 @@ class PhonemeInventory:
         :return: The phonemes satisfying the condition
         """
         if isinstance(features, str): features = [features]
-        phonemes = self.get_alphabet().copy()
-        for feature_name in features:
-            if feature_name in self._phoneme_sets:
-                phonemes &= self._phoneme_sets[feature_name].copy()
-            else:
-                phonemes = set()
-                print("No feature " + feature_name + " in this inventory")
+        return set(self._resolve_phonemes(tuple(features)))
+
+    def _resolve_phonemes(self, features):
+        """ Memoized get_phonemes for a tuple of features, returning a frozenset. """
+        phonemes = self._phoneme_cache.get(features)
+        if phonemes is None:
+            phonemes = frozenset(self._phoneme_sets["alph"])
+            for feature_name in features:
+                if feature_name in self._phoneme_sets:
+                    phonemes &= self._phoneme_sets[feature_name]
+                else:
+                    phonemes = frozenset()
+                    print("No feature " + feature_name + " in this inventory")
+            self._phoneme_cache[features] = phonemes
         return phonemes
 
     def get_feature_bundles(self, features, value="", filtr=None):
@@ -98,10 +108,17 @@ class PhonemeInventory:
                  given feature bundle.
         """
         if isinstance(features, str): features = [features]
-        feature_sets = list()
-        filter_phons = self.get_alphabet() if filtr is None else self.get_phonemes(filtr)
-        self.__add_feature_bundle(features, feature_sets, value, filter_phons)
-        return feature_sets
+        if isinstance(filtr, str): filtr = [filtr]
+        key = (tuple(features), value, None if filtr is None else tuple(filtr))
+        feature_sets = self._bundle_cache.get(key)
+        if feature_sets is None:
+            feature_sets = list()
+            filter_phons = frozenset(self._phoneme_sets["alph"]) if filtr is None \
+                else self._resolve_phonemes(tuple(filtr))
+            self.__add_feature_bundle(features, feature_sets, value, filter_phons)
+            feature_sets = [frozenset(feature_set) for feature_set in feature_sets]
+            self._bundle_cache[key] = feature_sets
+        return [set(feature_set) for feature_set in feature_sets]
 
     def __add_feature_bundle(self, features, feature_bundles, value, filtr):
         for feature_name in features:
@@ -123,10 +140,9 @@ class PhonemeInventory:
         :return: All phonemes ordered along the sonority scale
         """
         scaled_phon = list()
-        all_phon = self.get_alphabet().copy()
+        all_phon = self.get_alphabet()
         for step in scale:
-            level = self.get_phonemes(step).copy()
-            level &= all_phon
+            level = all_phon & self._resolve_phonemes((step,) if isinstance(step, str) else tuple(step))
             all_phon -= level
             scaled_phon.append(level)
         if len(all_phon) > 0:
@@ -134,3 +150,16 @@ class PhonemeInventory:
         return scaled_phon
 
 
+@lru_cache(maxsize=None)
+def _load_tables():
+    """
+    Read the phoneme and diacritic tables, which are shared by all inventories.
+    :return: The feature supergroups, the feature names and the columns of the symbol and diacritic tables
+    """
+    with open("phon_symbols.tsv", encoding="UTF-8") as sym_file:
+        sym_lines = sym_file.read().splitlines()
+    with open("phon_diacritics.tsv", encoding="UTF-8") as dia_file:
+        dia_lines = dia_file.read().splitlines()
+    sym_rows = tuple(tuple(line.split('\t')) for line in sym_lines)
+    dia_rows = tuple(tuple(line.split('\t')) for line in dia_lines)
+    return sym_rows[0][2:], sym_rows[1][2:], tuple(zip(*sym_rows[2:])), tuple(zip(*dia_rows[2:]))
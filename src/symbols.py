@@ -13,7 +13,7 @@ mark_sym = "[%*]"
 word_bound = "[%#]"
 syl_bound = "[%.]"
 nucl_bound = "[%,]"
-bound_syms = "[ " + word_bound + " | " + syl_bound + " | " + nucl_bound + " ]"
+bound_syms = "[" + word_bound + "|" + syl_bound + "|" + nucl_bound + "]"
 
 any_in = "[ \\" + out_sym + " ]+"
 any_out = "[ \\[ " + in_sym + " | " + bound_syms + " ] ]+"
@@ -1,17 +1,19 @@
 import hfst
+import itertools
 import re
 import time
 
-from constraint import penalize, pardon, Constraint
+from constraint import penalize, pardon, Constraint, _compile
 from gen import Generator
 from symbols import *
 
 
 class Tableau:
 
-    _align_syms = r"\>[^\<]+\<|\,"
-    _epsilon = r"@_EPSILON_SYMBOL_@"
-    _out_mark_chars = r"\>[^\<]+\<|\-|\*|\,|#\.|\.#"
+    _align_syms = re.compile(r"\>[^\<]+\<|\,")
+    _epsilon = re.compile(r"@_EPSILON_SYMBOL_@")
+    _out_mark_chars = re.compile(r"\>[^\<]+\<|\-|\*|\,|#\.|\.#")
+    _epsilon_align_syms = re.compile(_epsilon.pattern + r"|" + _align_syms.pattern)
 
     def __init__(self, gen, penal_method="matching"):
         """
@@ -23,6 +25,9 @@ class Tableau:
         self._constraints = list()
         self._runnable = hfst.empty_fst()  # Final FST for simple lookup
         self._stepwise = list()  # Intermediate FSTs for candidate tracing
+        self._stepwise_optimized = True  # Whether gen and the intermediate FSTs are converted for fast lookup yet
+        self._lookup_cache = dict()  # Lookups of the last traced input, reused if it is traced again
+        self._lookup_input = None
 
     def add_constraint(self, constraint):
         """
@@ -51,18 +56,21 @@ class Tableau:
                 tab_file.write(str(constraint) + "\n")
 
         fst_file = hfst.HfstOutputStream(filename=file_name + ".hfst")
-        self._write_ol_fst_to(self._gen, fst_file)
+        # Only the final FST is converted back right away, the others wait until candidates are traced
+        self._write_ol_fst_to(self._gen, fst_file, reoptimize=False)
         for (before, after) in self._stepwise:
-            self._write_ol_fst_to(before, fst_file)
-            self._write_ol_fst_to(after, fst_file)
+            self._write_ol_fst_to(before, fst_file, reoptimize=False)
+            self._write_ol_fst_to(after, fst_file, reoptimize=False)
+        self._stepwise_optimized = False
         self._write_ol_fst_to(self._runnable, fst_file)
         fst_file.close()
 
     @staticmethod
-    def _write_ol_fst_to(fst, outstream):
+    def _write_ol_fst_to(fst, outstream, reoptimize=True):
         fst.remove_optimization()
         outstream.write(fst)
-        Tableau._optimize_lookup(fst)
+        if reoptimize:
+            Tableau._optimize_lookup(fst)
 
     @staticmethod
     def _optimize_lookup(fst):
@@ -110,15 +118,20 @@ class Tableau:
 
         return tab
 
-    def build(self, verbosity=1):
+    def build(self, verbosity=1, keep_stepwise=True):
         """
         Build the tableau FST from the submitted gen and constraints.
         :param verbosity: Amount of information to be printed during building. 0 = print nothing,
                           1 = print progress in single line (default), 2+ = print time and FST size
                           for each constraint
+        :param keep_stepwise: Keep the intermediate FSTs for candidate tracing. Set to False to save time
+                              and memory if only the final FST is needed.
         """
-        start = time.time()
+        start = time.perf_counter()
 
+        self._lookup_cache.clear()
+        self._stepwise = list()
+        self._stepwise_optimized = True
         self._gen.remove_optimization()
         self._runnable = self._gen.copy()
         self._optimize_lookup(self._gen)
@@ -128,41 +141,40 @@ class Tableau:
 
         n = len(self._constraints)
         for (i, constraint) in enumerate(self._constraints):
-            c_start = time.time()
             if verbosity == 1:
                 print("\rApplying constraints... (%d/%d)" % (i, n), end="", flush=True)
             elif verbosity > 1:
+                c_start = time.perf_counter()
                 print("Constraint %d: " % i, end="", flush=True)
             constraint.apply(self._runnable, no_penalty=True)
             self._runnable.minimize()
-            before = self._runnable.copy()
-            self._optimize_lookup(before)
+            before = self._runnable.copy() if keep_stepwise else None
             penalize(self._runnable, constraint.n(), no_pardon=True, method=self._penal_method)
             self._runnable.minimize()
-            after = self._runnable.copy()
-            self._optimize_lookup(after)
+            after = self._runnable.copy() if keep_stepwise else None
             pardon(self._runnable)
             self._runnable.minimize()
-            self._stepwise.append((before, after))
+            if keep_stepwise:
+                # Converted for lookup only once candidates are actually traced
+                self._stepwise.append((before, after))
+                self._stepwise_optimized = False
             if verbosity > 1:
-                c_end = time.time()
+                c_end = time.perf_counter()
                 print("%d states, %d arcs (%.2f sec.)" %
                       (self._runnable.number_of_states(), self._runnable.number_of_arcs(), c_end-c_start), flush=True)
 
-        finish = hfst.regex(out_prefix
-                            + " | " + word_bound + " " + syl_bound
-                            + " | " + syl_bound + " " + word_bound
-                            + " | " + nucl_bound + " -> 0")
-        finish2 = hfst.regex(no_sym + " -> 0")
-        finish.compose(finish2)
-        self._runnable.compose(finish)
+        finish = _compile("[ " + out_prefix
+                          + " | " + word_bound + " " + syl_bound
+                          + " | " + syl_bound + " " + word_bound
+                          + " | " + nucl_bound + " -> 0 ] .o. [ " + no_sym + " -> 0 ]")
+        self._runnable.compose(finish.copy())
         self._runnable.minimize()
         if verbosity > 1:
             print("Final: %d states, %d arcs" % (self._runnable.number_of_states(), self._runnable.number_of_arcs()),
                   flush=True)
         self._optimize_lookup(self._runnable)
 
-        end = time.time()
+        end = time.perf_counter()
         if verbosity > 0:
             if verbosity == 1: print("\r", end="")
             print("Build complete in %.2f seconds." % (end-start), flush=True)
@@ -197,7 +209,7 @@ class Tableau:
             else:
                 print(quot + desired_winner + quot + " loses against:")
 
-        for winner in list(winners)[:n]:
+        for winner in itertools.islice(winners, n):
             print("\'" + winner + "\'")
         if too_many:
             print("etc.")
@@ -214,44 +226,57 @@ class Tableau:
         :param n: The number of candidates to be retrieved at each step
         :return:
         """
-        gen_inf = self._gen.is_infinitely_ambiguous()
-        candidates = None if gen_inf else Tableau._reformat(
-            Tableau._weightless_lookup(self._gen, input_string, n=n + 1), verbose)
+        self._optimize_stepwise()
+        traced = frozenset(traced)
+        # Only the lookups of the last input are kept, large n would make keeping all of them too costly
+        if input_string != self._lookup_input:
+            self._lookup_cache.clear()
+            self._lookup_input = input_string
+        candidates = self._trace_lookup(self._gen, input_string, n + 1, verbose)
         print("0")
         Tableau._print_lookup(candidates, traced, "Candidates", n, show_traced_only)
 
         # Apply constraints
         for (i, (before, after)) in enumerate(self._stepwise):
             # Get marked candidates
-            fatal_inf = before.is_infinitely_ambiguous()
-            fatalities = None if fatal_inf else Tableau._reformat(
-                Tableau._weightless_lookup(before, input_string, n=n + 1), verbose)
+            fatalities = self._trace_lookup(before, input_string, n + 1, verbose)
             # Get survivors
-            surviv_inf = after.is_infinitely_ambiguous()
-            survivors = None if surviv_inf else Tableau._reformat(
-                Tableau._weightless_lookup(after, input_string, n=n + 1), verbose)
+            survivors = self._trace_lookup(after, input_string, n + 1, verbose)
             # Get fatalities
-            fatal_unknown = fatal_inf or len(fatalities) > n
-            if not fatal_unknown: fatalities -= survivors
+            fatal_unknown = fatalities is None or len(fatalities) > n
+            if not fatal_unknown and survivors is not None: fatalities -= survivors
             # Print results
             print(str(i+1))
             Tableau._print_lookup(fatalities, traced, "Fatalities", n, show_traced_only,
                                   numbers_exact=not fatal_unknown)
             Tableau._print_lookup(survivors, traced, "Survivors", n, show_traced_only)
 
+    def _optimize_stepwise(self):
+        if not self._stepwise_optimized:
+            self._optimize_lookup(self._gen)
+            for (before, after) in self._stepwise:
+                self._optimize_lookup(before)
+                self._optimize_lookup(after)
+            self._stepwise_optimized = True
+
+    def _trace_lookup(self, fst, input_string, n, verbose):
+        """ :return: The reformatted candidates for the input, or None if there are infinitely many """
+        key = (id(fst), input_string, n)
+        if key not in self._lookup_cache:
+            self._lookup_cache[key] = None if fst.is_infinitely_ambiguous() \
+                else Tableau._weightless_lookup(fst, input_string, n=n)
+        candidates = self._lookup_cache[key]
+        # Reformatting may merge candidates, so it is needed even if the lookup returned more than n
+        return None if candidates is None else Tableau._reformat(candidates, verbose)
+
     @staticmethod
     def _weightless_lookup(fst, input_string, n=20):
-        lookup = fst.lookup(input_string, max_number=n)
-        winners = set()
-        for winner in lookup:
-            winners.add(winner[0])
-        return winners
+        return {winner[0] for winner in fst.lookup(input_string, max_number=n)}
 
     @staticmethod
     def _reformat(candidates, verbose):
-        candidates = {re.sub(Tableau._epsilon, "", cand) for cand in candidates}
-        if not verbose: candidates = {re.sub(Tableau._align_syms, "", cand) for cand in candidates}
-        return candidates
+        strip = Tableau._epsilon if verbose else Tableau._epsilon_align_syms
+        return {strip.sub("", cand) for cand in candidates}
 
     @staticmethod
     def _print_lookup(output, traced, label, n, show_traced_only, numbers_exact=True):
@@ -266,9 +291,9 @@ class Tableau:
                     trace_match = set()
                     trace_others = set()
                     for cand in output:
-                        norm_cand = re.sub(Tableau._out_mark_chars, "", cand)
+                        norm_cand = Tableau._out_mark_chars.sub("", cand)
                         if norm_cand in traced: trace_match.add(cand)
-                        elif len(trace_others) <= n: trace_others.add(cand)
+                        elif not show_traced_only and len(trace_others) <= n: trace_others.add(cand)
                     print("\ttraced: " + ("(none)" if len(trace_match) == 0 else str(trace_match)))
                     if not show_traced_only:
                         print("\tuntraced: " + ("(none)" if len(trace_others) == 0 else str(trace_others)))